@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Times ``nodeenv.download_file()`` against a local HTTP server which limits
+the rate of every connection, as mirrors commonly do, to compare
+single-stream and segmented downloads.
+
+Usage: python download_bench.py [SIZE_MB] [KB_PER_SECOND_PER_CONNECTION]
+"""
+
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import nodeenv
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    # Python 2.x
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    import socketserver
+except ImportError:
+    # Python 2.x
+    import SocketServer as socketserver
+
+
+class ThrottledHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        data = self.server.data
+        first, last = 0, len(data) - 1
+        m = re.match(r'bytes=(\d+)-(\d+)$', self.headers.get('Range') or '')
+        if m:
+            first, last = int(m.group(1)), min(int(m.group(2)), last)
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (first, last, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(last - first + 1))
+        self.end_headers()
+
+        chunk = 16 * 1024
+        delay = chunk / float(self.server.rate)
+        for pos in range(first, last + 1, chunk):
+            self.wfile.write(data[pos:min(pos + chunk, last + 1)])
+            time.sleep(delay)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThrottledServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    rate_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 2048
+
+    server = ThrottledServer(('127.0.0.1', 0), ThrottledHandler)
+    server.data = os.urandom(size_mb * 1024 * 1024)
+    server.rate = rate_kb * 1024
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    url = 'http://%s:%d/node.tar.gz' % server.server_address
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        print(' * %d MB at %d KB/s per connection' % (size_mb, rate_kb))
+        for segments in (1, 4, 8):
+            dest = os.path.join(tmp_dir, 'node-%d.tar.gz' % segments)
+            start = time.time()
+            nodeenv.download_file(url, dest, segments)
+            elapsed = time.time() - start
+            with open(dest, 'rb') as f:
+                if f.read() != server.data:
+                    raise SystemExit('segments=%d: corrupted download'
+                                     % segments)
+            print('   segments=%d: %.1fs, %.1f MB/s'
+                  % (segments, elapsed, size_mb / elapsed))
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -20,10 +20,23 @@ import optparse
 import subprocess
 import pipes
 import re
+import io
 import tempfile
+import tarfile
 import zipfile
 import shutil
+import copy
+import collections
+import errno
+import base64
+import hashlib
+import json
+import socket
+import threading
+import time
+import uuid
 from distutils.dir_util import copy_tree
+from distutils.spawn import find_executable
 
 try:
     import ConfigParser
@@ -31,6 +44,18 @@ except ImportError:
     # Python 3
     import configparser as ConfigParser
 
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+try:
+    import socketserver
+except ImportError:
+    # Python 2.x
+    import SocketServer as socketserver
+
 try:
     import urllib.request as urllib
 except ImportError:
@@ -43,6 +68,24 @@ except ImportError:
     # Python 2.x
     from urllib2 import HTTPError
 
+try:
+    from http.client import HTTPException
+except ImportError:
+    # Python 2.x
+    from httplib import HTTPException
+
+try:
+    import queue
+except ImportError:
+    # Python 2.x
+    import Queue as queue
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    # Python 2.x
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
 from pkg_resources import parse_version
 
 join = os.path.join
@@ -50,10 +93,77 @@ abspath = os.path.abspath
 
 is_windows_nt = os.name == 'nt'
 
+# Named sets of node.js features, as ./configure switches, selected with
+# --features. Presets without ``npm`` build node without its bundled npm;
+# npm is then installed from the registry tarball.
+FEATURE_PRESETS = {
+    'full': {
+        'configure': [],
+    },
+    'small': {
+        'configure': ['--with-intl=small-icu'],
+    },
+    'minimal': {
+        'configure': ['--with-intl=none', '--without-inspector'],
+    },
+    'bare': {
+        'configure': ['--with-intl=none', '--without-inspector',
+                      '--without-npm'],
+        'npm': False,
+    },
+}
+
+# Named sets of ./configure switches and compiler flags for the node.js
+# build, selected with --build-profile. Profiles with ``pgo`` build node
+# twice: instrumented, then optimized with the profile of a training run.
+BUILD_PROFILES = {
+    'default': {
+        'configure': [],
+        'env': {},
+    },
+    'native': {
+        'configure': [],
+        'env': {'CFLAGS': '-O3 -march=native',
+                'CXXFLAGS': '-O3 -march=native'},
+    },
+    'fast': {
+        'configure': ['--enable-lto'],
+        'env': {'CFLAGS': '-O3 -march=native',
+                'CXXFLAGS': '-O3 -march=native'},
+    },
+    'pgo': {
+        'configure': ['--enable-lto'],
+        'env': {'CFLAGS': '-O3 -march=native',
+                'CXXFLAGS': '-O3 -march=native'},
+        'pgo': True,
+    },
+}
+
 # ---------------------------------------------------------
 # Utils
 
 
+class NodeenvError(Exception):
+    """
+    Raised when an environment can not be created or managed
+    """
+
+
+class ContinuedStreamHandler(logging.StreamHandler):
+    """
+    Stream handler which does not terminate records marked as ``continued``
+    with a newline, so several records can be written on one line
+    """
+    def emit(self, record):
+        try:
+            msg = self.format(record)
+            fs = "%s" if getattr(record, "continued", False) else "%s\n"
+            self.stream.write(fs % msg)
+            self.flush()
+        except Exception:
+            self.handleError(record)
+
+
 def create_logger():
     """
     Create logger for diagnostic
@@ -62,16 +172,14 @@ def create_logger():
     logger = logging.getLogger("nodeenv")
     logger.setLevel(logging.INFO)
 
-    # monkey patch
-    def emit(self, record):
-        msg = self.format(record)
-        fs = "%s" if getattr(record, "continued", False) else "%s\n"
-        self.stream.write(fs % msg)
-        self.flush()
-    logging.StreamHandler.emit = emit
+    # console handler is attached only once, even if main() is called
+    # several times within one process
+    for handler in logger.handlers:
+        if isinstance(handler, ContinuedStreamHandler):
+            return logger
 
     # create console handler and set level to debug
-    ch = logging.StreamHandler()
+    ch = ContinuedStreamHandler()
     ch.setLevel(logging.DEBUG)
 
     # create formatter
@@ -83,12 +191,16 @@ def create_logger():
     # add ch to logger
     logger.addHandler(ch)
     return logger
-logger = create_logger()
 
+# Library users get no output unless they configure logging themselves;
+# the console handler is attached by main() only.
+logger = logging.getLogger("nodeenv")
+logger.addHandler(logging.NullHandler())
 
-def parse_args():
+
+def make_parser():
     """
-    Parses command line arguments
+    Returns the command line parser
     """
     parser = optparse.OptionParser(
         version=nodeenv_version,
@@ -105,9 +217,24 @@ def parse_args():
         help='Sets number of parallel commands at node.js compilation. '
         'The default is 2 jobs.')
 
+    parser.add_option('--build-system', dest='build_system',
+        type='choice', choices=['auto', 'make', 'ninja'], default='auto',
+        help='Build node.js with make or ninja. "auto" uses ninja when it is '
+        'installed and supported by the node.js version. The default is auto.')
+
     parser.add_option('--load-average', dest='load_average',
         help='Sets maximum load average for executing parallel commands at node.js compilation.')
 
+    parser.add_option('--download-segments', dest='download_segments',
+        default='4',
+        help='Sets number of parallel connections used to download node.js. '
+        'The default is 4 connections.')
+
+    parser.add_option('--download-timeout', dest='download_timeout',
+        default='60',
+        help='Sets number of seconds a download connection may stall before '
+        'it is retried. The default is 60 seconds.')
+
     parser.add_option('-v', '--verbose',
         action='store_true', dest='verbose', default=False,
         help="Verbose mode")
@@ -120,6 +247,23 @@ def parse_args():
         dest='requirements', default='', metavar='FILENAME',
         help='Install all the packages listed in the given requirements file.')
 
+    parser.add_option('--prefetch', dest='prefetch',
+        action='store_true', default=False,
+        help='Download the packages of the requirements file and all their '
+        'dependencies into the directory given by --into, for use with '
+        '--package-mirror')
+
+    parser.add_option('--into', dest='prefetch_dir', metavar='DIR',
+        help='Directory the --prefetch packages are downloaded into')
+
+    parser.add_option('--prefetch-jobs', dest='prefetch_jobs', default='8',
+        help='Sets number of parallel downloads for --prefetch. '
+        'The default is 8 downloads.')
+
+    parser.add_option('--package-mirror', dest='package_mirror', metavar='DIR',
+        help='Install the packages of the requirements file from a '
+        'directory filled by --prefetch, without using the registry')
+
     parser.add_option('--prompt', dest='prompt',
         help='Provides an alternative prompt prefix for this environment')
 
@@ -139,6 +283,41 @@ def parse_args():
         action='store_true', default=False,
         help='Enable profiling for node.js')
 
+    parser.add_option('--features', dest='features',
+        type='choice', choices=sorted(FEATURE_PRESETS), default='full',
+        help='Build node.js with a named set of features: %s. "small" uses '
+        'small-icu, "minimal" drops intl and the inspector, "bare" also '
+        'drops the bundled npm. The default is "full".'
+        % ', '.join(sorted(FEATURE_PRESETS)))
+
+    parser.add_option('--build-profile', dest='build_profile',
+        type='choice', choices=sorted(BUILD_PROFILES), default='default',
+        help='Build node.js with a named set of optimizations: %s. '
+        '"native", "fast" and "pgo" tune for the CPU of the build host; '
+        '"fast" adds LTO and "pgo" adds profile guided optimization. '
+        'The default is "default".' % ', '.join(sorted(BUILD_PROFILES)))
+
+    parser.add_option('--side-by-side', dest='side_by_side',
+        action='store_true', default=False,
+        help='Install node.js into a per-version prefix inside the '
+        'environment, so several versions can be installed with --force '
+        'and switched between with --use')
+
+    parser.add_option('--use', dest='use',
+        metavar='NODE_VER', default=None,
+        help='Switch the active node.js version of a --side-by-side '
+        'environment: nodeenv --use=NODE_VER ENV_DIR')
+
+    parser.add_option('--slim', dest='slim',
+        action='store_true', default=False,
+        help='Strip the installed binaries and remove headers, docs and '
+        'man pages from the new virtual environment')
+
+    parser.add_option('--keep-headers', dest='keep_headers',
+        action='store_true', default=False,
+        help='Keep the node.js headers with --slim, e.g. to build native '
+        'addons with npm')
+
     parser.add_option('--with-npm', dest='with_npm',
         action='store_true', default=False,
         help='Build without installing npm into the new virtual environment. '
@@ -152,7 +331,8 @@ def parse_args():
 
     parser.add_option('--no-npm-clean', dest='no_npm_clean',
         action='store_true', default=False,
-        help='Skip the npm 0.x cleanup.  Cleanup is enabled by default.')
+        help='Update an existing npm in place, file by file, instead of '
+        'replacing it. By default an existing npm is removed first.')
 
     parser.add_option('--python-virtualenv', '-p', dest='python_virtualenv',
         action='store_true', default=False,
@@ -164,11 +344,137 @@ def parse_args():
 
     parser.add_option('--force', dest='force',
         action='store_true', default=False,
-        help='Force installation in a pre-existing directory')
+        help='Force installation in a pre-existing directory. Environments '
+        'nodeenv built are rebuilt next to it and swapped in, other '
+        'directories are installed into in place')
+
+    parser.add_option('--clone', dest='clone',
+        metavar='SRC_ENV_DIR', default=None,
+        help='Create the new environment as a copy of an existing one '
+        'instead of building it')
+
+    parser.add_option('--update', dest='update',
+        action='store_true', default=False,
+        help='Install npm and packages into an existing environment')
+
+    parser.add_option('--pack', dest='pack',
+        action='store_true', default=False,
+        help='Pack the environment into an archive: nodeenv --pack ENV_DIR '
+        'ARCHIVE. Use a .tar.zst or .tar.gz suffix to select the compression.')
+
+    parser.add_option('--unpack', dest='unpack',
+        action='store_true', default=False,
+        help='Restore an environment packed with --pack: nodeenv --unpack '
+        'ARCHIVE ENV_DIR')
+
+    parser.add_option('--exec', dest='exec_cmd',
+        action='store_true', default=False,
+        help='Run a command inside the environment without activating it: '
+        'nodeenv --exec ENV_DIR [--] COMMAND [ARGS...]; options must come '
+        'before ENV_DIR')
+
+    parser.add_option('--bench', dest='bench',
+        action='store_true', default=False,
+        help='Run benchmarks with the node.js of each environment and '
+        'compare them: nodeenv --bench ENV_DIR [ENV_DIR...]')
 
-    options, args = parser.parse_args()
+    parser.add_option('--bench-script', dest='bench_scripts',
+        action='append', default=[], metavar='FILENAME',
+        help='Also time the given script with --bench; may be repeated')
 
-    if not options.list and not options.python_virtualenv:
+    parser.add_option('--bench-runs', dest='bench_runs', default='5',
+        help='Sets number of runs of each benchmark. The default is 5 runs.')
+
+    parser.add_option('--bench-json', dest='bench_json', metavar='FILENAME',
+        help='Write the --bench results as JSON into the given file')
+
+    parser.add_option('--serve', dest='serve',
+        metavar='SOCKET', default=None,
+        help='Run a nodeenv service on the given Unix socket, which creates, '
+        'clones and updates environments for clients using --server')
+
+    parser.add_option('--server', dest='server',
+        metavar='SOCKET', default=None,
+        help='Send the create, clone or update request to the nodeenv '
+        'service listening on the given Unix socket')
+
+    parser.add_option('--max-builds', dest='max_builds', default='2',
+        help='Sets maximum number of node.js builds run at once by the '
+        'nodeenv service. The default is 2 builds.')
+
+    parser.add_option('--cache-dir', dest='cache_dir',
+        metavar='DIR', default=join(os.path.expanduser('~'), '.nodeenv', 'cache'),
+        help='Directory for cached downloads and the environments built by '
+        'the nodeenv service. The default is ~/.nodeenv/cache.')
+
+    return parser
+
+
+def make_options(**kwargs):
+    """
+    Returns an options object filled with the command line defaults,
+    overridden by ``kwargs``. This is the options object expected by
+    ``create_environment()`` when nodeenv is used as a library.
+    """
+    options, args = make_parser().parse_args([])
+    for name, value in kwargs.items():
+        if not hasattr(options, name):
+            raise TypeError('Unknown nodeenv option: %s' % name)
+        setattr(options, name, value)
+    return options
+
+
+def parse_args(args=None):
+    """
+    Parses command line arguments
+    """
+    parser = make_parser()
+    if args is None:
+        args = sys.argv[1:]
+    # options of the command run with --exec must not be taken for ours,
+    # so parsing stops at ENV_DIR
+    if '--exec' in args[:args.index('--') if '--' in args else len(args)]:
+        parser.disable_interspersed_args()
+    options, args = parser.parse_args(args)
+    if options.exec_cmd and len(args) > 1 and args[1] == '--':
+        del args[1]
+
+    if options.prefetch:
+        if not options.requirements or not options.prefetch_dir:
+            print('--prefetch needs a requirements file (-r) and a '
+                  'directory (--into)')
+            parser.print_help()
+            sys.exit(2)
+    elif options.bench:
+        if not args:
+            print('You must provide at least one ENV_DIR to benchmark')
+            parser.print_help()
+            sys.exit(2)
+        if not options.bench_runs.isdigit() or int(options.bench_runs) < 1:
+            print('--bench-runs must be a number of at least 1 (you gave %s)'
+                  % options.bench_runs)
+            parser.print_help()
+            sys.exit(2)
+    elif options.exec_cmd:
+        if len(args) < 2:
+            print('There must be an ENV_DIR and a COMMAND (you gave %s)' % (
+                ' '.join(args)))
+            parser.print_help()
+            sys.exit(2)
+    elif options.use:
+        if len(args) != 1:
+            print('There must be only one argument: ENV_DIR (you gave %s)' % (
+                ' '.join(args)))
+            parser.print_help()
+            sys.exit(2)
+    elif options.pack or options.unpack:
+        if len(args) != 2:
+            print('There must be two arguments: %s (you gave %s)' % (
+                'ENV_DIR ARCHIVE' if options.pack else 'ARCHIVE ENV_DIR',
+                ' '.join(args)))
+            parser.print_help()
+            sys.exit(2)
+    elif not options.list and not options.python_virtualenv and not options.serve:
         if not args:
             print('You must provide a DEST_DIR or use current python virtualenv')
             parser.print_help()
@@ -183,13 +489,62 @@ def parse_args():
     return options, args
 
 
+class FileLock(object):
+    """
+    Exclusive lock on ``path``, held between processes as well as threads.
+    Without fcntl (Windows) only the threads of this process are excluded.
+    """
+    thread_locks = {}
+    thread_locks_guard = threading.Lock()
+
+    def __init__(self, path):
+        self.path = abspath(path)
+        self.f = None
+        with self.thread_locks_guard:
+            self.thread_lock = self.thread_locks.setdefault(self.path,
+                                                           threading.Lock())
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        if fcntl is not None:
+            try:
+                try:
+                    self.f = open(self.path, 'a')
+                except IOError:
+                    e = sys.exc_info()[1]
+                    # created by another user, e.g. through sudo
+                    if e.errno != errno.EACCES:
+                        raise
+                    self.f = open(self.path, 'r')
+                fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+            except BaseException:
+                if self.f:
+                    self.f.close()
+                self.thread_lock.release()
+                raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.f:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+            self.f.close()
+            self.f = None
+        self.thread_lock.release()
+
+
 def mkdir(path):
     """
     Create directory
     """
     if not os.path.exists(path):
         logger.debug(' * Creating: %s ... ', path, extra=dict(continued=True))
-        os.makedirs(path)
+        try:
+            os.makedirs(path)
+        except OSError:
+            e = sys.exc_info()[1]
+            # created by another thread or process in the meantime
+            if e.errno != errno.EEXIST or not os.path.isdir(path):
+                raise
         logger.debug('done.')
     else:
         logger.debug(' * Directory %s already exists', path)
@@ -227,6 +582,33 @@ def get_mod_dir(opt, env_dir=None):
 
     return mod_dir
 
+def get_node_prefix(opt, env_dir):
+    """
+    Returns the prefix node.js is installed into: the env root, or the
+    per-version directory for side by side environments.
+    """
+    if opt.side_by_side:
+        return join(env_dir, 'versions', opt.node)
+    return env_dir
+
+def get_env_vars(env_dir, opt):
+    """
+    Returns the environment variables set by the activate script,
+    computed without running a shell
+    """
+    env_dir = abspath(env_dir)
+    bin_dir = get_bin_dir(opt, env_dir)
+    if is_windows_nt:
+        npm_prefix = bin_dir
+    else:
+        npm_prefix = env_dir
+    return {
+        'NODE_VIRTUAL_ENV': env_dir,
+        'PATH': bin_dir + os.pathsep + os.environ.get('PATH', ''),
+        'NODE_PATH': get_mod_dir(opt, env_dir),
+        'NPM_CONFIG_PREFIX': npm_prefix,
+    }
+
 def writefile(dest, content, overwrite=True, append=False):
     """
     Create file and write content in it
@@ -334,6 +716,115 @@ def get_node_src_url(version, postfix=''):
         node_url = 'http://nodejs.org/dist/%s' % (tar_name)
     return node_url
 
+class RangeNotSupported(Exception):
+    pass
+
+
+def fetch_range(url, path, start, end, retries=3, timeout=60):
+    """
+    Downloads the bytes ``start``-``end`` of ``url`` into the same offsets
+    of the file ``path``, resuming from the last written byte on errors,
+    including a connection stalled for ``timeout`` seconds
+    """
+    offset = start
+    attempt = 0
+    while offset <= end:
+        r = None
+        try:
+            request = urllib.Request(url, headers={
+                'Range': 'bytes=%d-%d' % (offset, end)})
+            r = urllib.urlopen(request, timeout=timeout)
+            if r.getcode() != 206:
+                raise RangeNotSupported(url)
+            with open(path, 'r+b') as f:
+                f.seek(offset)
+                while offset <= end:
+                    chunk = r.read(min(64 * 1024, end - offset + 1))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    offset += len(chunk)
+            if offset <= end:
+                raise IOError('Connection closed at byte %d of %s' % (offset, url))
+        except (IOError, OSError, HTTPException, socket.timeout):
+            attempt += 1
+            if attempt > retries:
+                raise
+            logger.debug(' * Retrying bytes %d-%d of %s', offset, end, url)
+        finally:
+            if r: r.close()
+
+
+def download_file(url, dest, segments=4, min_segment_size=1024 * 1024,
+                  timeout=60):
+    """
+    Downloads ``url`` to ``dest`` over ``segments`` parallel connections,
+    each fetching one byte range. Servers which do not support ranges, and
+    small files, are downloaded over a single connection. A connection
+    idle for ``timeout`` seconds fails, or is retried for a byte range.
+    """
+    start = time.time()
+    part_path = dest + '.part'
+    headers = {} if segments <= 1 else {'Range': 'bytes=0-0'}
+    r = urllib.urlopen(urllib.Request(url, headers=headers), timeout=timeout)
+    try:
+        content_range = r.info().get('Content-Range') or ''
+        m = re.match(r'bytes 0-0/(\d+)$', content_range.strip())
+        if r.getcode() != 206 or not m:
+            # the server sent the whole file
+            try:
+                with open(part_path, 'wb') as f:
+                    shutil.copyfileobj(r, f, 64 * 1024)
+                    length = r.info().get('Content-Length')
+                    if length and f.tell() != int(length):
+                        raise IOError('Connection closed at byte %d of %s'
+                                      % (f.tell(), url))
+            except Exception:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                raise
+            os.rename(part_path, dest)
+            return
+    finally:
+        r.close()
+
+    size = int(m.group(1))
+    segments = max(1, min(segments, size // min_segment_size))
+    with open(part_path, 'wb') as f:
+        f.truncate(size)
+
+    bounds = []
+    segment_size = size // segments
+    for i in range(segments):
+        first = i * segment_size
+        last = size - 1 if i == segments - 1 else first + segment_size - 1
+        bounds.append((first, last))
+
+    errors = []
+    def fetch(first, last):
+        try:
+            fetch_range(url, part_path, first, last, timeout=timeout)
+        except Exception:
+            errors.append(sys.exc_info()[1])
+    threads = [threading.Thread(target=fetch, args=b) for b in bounds]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
+        os.remove(part_path)
+        if any(isinstance(e, RangeNotSupported) for e in errors):
+            # ranges were only honoured for the probe
+            return download_file(url, dest, segments=0, timeout=timeout)
+        raise errors[0]
+    os.rename(part_path, dest)
+    elapsed = max(time.time() - start, 1e-6)
+    logger.debug(' * Downloaded %s: %d bytes over %d connections, %.1f MB/s',
+                 url, size, segments, size / elapsed / 1024 / 1024)
+
+
 def download_node_win(dest_dir, opt):
     """
     Download the Windows node binary.
@@ -346,17 +837,14 @@ def download_node_win(dest_dir, opt):
         node_url += 'x64/'
     node_url += 'node.exe'
 
-    r = None
     try:
-        r = urllib.urlopen(node_url)
-        with open(join(dest_dir, 'node-venv.exe'), 'wb') as f:
-            f.write(r.read())
+        download_file(node_url, join(dest_dir, 'node-venv.exe'),
+                      int(opt.download_segments),
+                      timeout=float(opt.download_timeout))
     except HTTPError:
         logger.error('The requested version of node does not exist for Windows. '
                      'Use the -l option to see available versions.')
         raise
-    finally:
-        if r: r.close()
 
 
 def download_node(node_url, src_dir, env_dir, opt):
@@ -367,26 +855,29 @@ def download_node(node_url, src_dir, env_dir, opt):
         raise NotImplementedError('Downloading the node source code is not '
                                   'supported on Windows.')
 
-    cmd = []
-    cmd.append('curl')
-    cmd.append('--silent')
-    cmd.append('-L')
-    cmd.append(node_url)
-    cmd.append('|')
-    cmd.append('tar')
-    cmd.append('xzf')
-    cmd.append('-')
-    cmd.append('-C')
-    cmd.append(pipes.quote(src_dir))
+    node_tar = join(src_dir, os.path.basename(node_url))
     try:
-        callit(cmd, opt.verbose, True, env_dir)
+        download_file(node_url, node_tar, int(opt.download_segments),
+                      timeout=float(opt.download_timeout))
         logger.info(') ', extra=dict(continued=True))
-    except OSError:
+    except HTTPError:
         postfix = '-RC1'
         logger.info('%s) ' % postfix, extra=dict(continued=True))
-        new_node_url = get_node_src_url(opt.node, postfix)
-        cmd[cmd.index(node_url)] = new_node_url
-        callit(cmd, opt.verbose, True, env_dir)
+        node_url = get_node_src_url(opt.node, postfix)
+        node_tar = join(src_dir, os.path.basename(node_url))
+        download_file(node_url, node_tar, int(opt.download_segments),
+                      timeout=float(opt.download_timeout))
+
+    top_dir = os.path.basename(node_tar)[:-len('.tar.gz')] + '/'
+    def is_safe(name):
+        return name.startswith(top_dir) and '..' not in name.split('/')
+    with tarfile.open(node_tar, 'r:gz') as tar:
+        members = [m for m in tar.getmembers()
+                   if is_safe(m.name) and
+                   (m.isreg() or m.isdir() or m.issym() or
+                    (m.islnk() and is_safe(m.linkname)))]
+        tar.extractall(src_dir, members)
+    os.remove(node_tar)
 
 # ---------------------------------------------------------
 # Virtual environment functions
@@ -416,6 +907,118 @@ def install_node_win(env_dir, opt):
     download_node_win(bin_dir, opt)
     logger.info(' done.')
 
+def get_build_profile_env(name):
+    """
+    Returns the compiler environment variables of the build profile,
+    appended to the ones already set
+    """
+    env = {}
+    for var, flags in BUILD_PROFILES[name]['env'].items():
+        if os.environ.get(var):
+            flags = '%s %s' % (os.environ[var], flags)
+        env[var] = flags
+    return env
+
+def train_node(node_src_dir, opt):
+    """
+    Runs the instrumented node.js binary on a training workload
+    to collect the profile for the optimized build
+    """
+    script_path = join(node_src_dir, 'nodeenv-pgo-training.js')
+    writefile(script_path, PGO_TRAINING_JS)
+    node_bin = join(node_src_dir, 'out', 'Debug' if opt.debug else 'Release', 'node')
+    callit([node_bin, script_path], opt.verbose, False, node_src_dir)
+
+def configure_help(node_src_dir):
+    """
+    Returns the help of the node.js configure script
+    """
+    returncode, output = callit(['./configure', '--help'], False, False,
+                                node_src_dir)
+    return '\n'.join(line.decode('utf-8', 'replace')
+                     if isinstance(line, bytes) else line for line in output)
+
+def check_configure_switches(node_src_dir, switches, needed_by, opt):
+    """
+    Fails before the build if the configure script of this node.js version
+    lacks one of ``switches``
+    """
+    if not switches:
+        return
+    help_text = configure_help(node_src_dir)
+    missing = [switch for switch in switches
+               if not re.search(r'(^|\s)%s(?=[\s=,\[]|$)'
+                                % re.escape(switch.split('=')[0]),
+                                help_text, re.M)]
+    if missing:
+        raise NodeenvError('node.js %s does not support %s, needed by %s'
+                           % (opt.node, ', '.join(missing), needed_by))
+
+def check_features(node_src_dir, opt):
+    """
+    Checks the configure switches of the selected feature preset
+    and build profile
+    """
+    switches = list(FEATURE_PRESETS[opt.features]['configure'])
+    check_configure_switches(node_src_dir, switches,
+                             'the "%s" features' % opt.features, opt)
+    profile = BUILD_PROFILES[opt.build_profile]
+    switches = list(profile['configure'])
+    if profile.get('pgo'):
+        switches.extend(['--enable-pgo-generate', '--enable-pgo-use'])
+    check_configure_switches(node_src_dir, switches,
+                             'the "%s" build profile' % opt.build_profile, opt)
+
+def makefile_uses_build_with(node_src_dir):
+    """
+    Tells whether the node.js Makefile honours BUILD_WITH=ninja
+    """
+    makefile = join(node_src_dir, 'Makefile')
+    if not os.path.exists(makefile):
+        return False
+    with open(makefile, 'rb') as f:
+        return b'BUILD_WITH' in f.read()
+
+def get_build_system(node_src_dir, opt):
+    """
+    Returns the build system, make or ninja, to build node.js with
+    """
+    if opt.build_system == 'make':
+        return 'make'
+    has_ninja = find_executable('ninja') is not None
+    # 'make install' must hand the build over to ninja, otherwise it
+    # rebuilds node with make; old releases accept --ninja but do not
+    supports_ninja = '--ninja' in configure_help(node_src_dir) and \
+        makefile_uses_build_with(node_src_dir)
+    if opt.build_system == 'ninja':
+        if not has_ninja:
+            raise NodeenvError('ninja is not installed')
+        if not supports_ninja:
+            raise NodeenvError('node.js %s can not be built with ninja' % opt.node)
+        return 'ninja'
+    if has_ninja and supports_ninja:
+        return 'ninja'
+    return 'make'
+
+def build_node(node_src_dir, build_system, make_opts, opt, env):
+    """
+    Runs the build of the configured node.js sources and returns
+    the time it took in seconds
+    """
+    start = time.time()
+    if build_system == 'ninja':
+        configs = ['Release', 'Debug'] if opt.debug else ['Release']
+        for config in configs:
+            cmd = ['ninja', '-C', join('out', config)]
+            if opt.jobs:
+                cmd.append('-j%s' % opt.jobs)
+            if opt.load_average:
+                cmd.append('-l%s' % opt.load_average)
+            callit(cmd, opt.verbose, True, node_src_dir, env)
+    else:
+        callit(['make']+make_opts, opt.verbose, True, node_src_dir, env)
+    return time.time() - start
+
 def install_node(env_dir, src_dir, opt):
     """
     Download source code for node.js, unpack it
@@ -433,15 +1036,21 @@ def install_node(env_dir, src_dir, opt):
     node_tar = join(src_dir, tar_name)
     node_src_dir = join(src_dir, node_name)
     env_dir = abspath(env_dir)
+    prefix = get_node_prefix(opt, env_dir)
     old_chdir = os.getcwd()
 
+    if opt.side_by_side and os.path.exists(join(prefix, 'bin', 'node')):
+        logger.info(') already installed.')
+        return
+
     # get src if not downloaded yet
     if not os.path.exists(node_src_dir):
         download_node(node_url, src_dir, env_dir, opt)
 
     logger.info('.', extra=dict(continued=True))
 
-    env = {}
+    profile = BUILD_PROFILES[opt.build_profile]
+    env = get_build_profile_env(opt.build_profile)
     make_param_names = ['load-average', 'jobs']
     make_param_values = map(lambda x: getattr(opt, x.replace('-','_')), make_param_names)
     make_opts = [ '--{0}={1}'.format(name, value)
@@ -449,23 +1058,79 @@ def install_node(env_dir, src_dir, opt):
                   for name, value in zip(make_param_names, make_param_values)
                   if value is not None ]
 
+    check_features(node_src_dir, opt)
+    build_system = get_build_system(node_src_dir, opt)
+    build_time = 0
+
     conf_cmd = []
     conf_cmd.append('./configure')
-    conf_cmd.append('--prefix=%s' % pipes.quote(env_dir))
+    conf_cmd.append('--prefix=%s' % pipes.quote(prefix))
+    if build_system == 'ninja':
+        conf_cmd.append('--ninja')
     if opt.without_ssl:
         conf_cmd.append('--without-ssl')
     if opt.debug:
         conf_cmd.append('--debug')
     if opt.profile:
         conf_cmd.append('--profile')
+    conf_cmd.extend(FEATURE_PRESETS[opt.features]['configure'])
+    conf_cmd.extend(profile['configure'])
+
+    if profile.get('pgo'):
+        callit(conf_cmd + ['--enable-pgo-generate'], opt.verbose, True,
+               node_src_dir, env)
+        logger.info('.', extra=dict(continued=True))
+        build_time += build_node(node_src_dir, build_system, make_opts, opt, env)
+        logger.info('.', extra=dict(continued=True))
+        train_node(node_src_dir, opt)
+        conf_cmd.append('--enable-pgo-use')
 
     callit(conf_cmd, opt.verbose, True, node_src_dir, env)
     logger.info('.', extra=dict(continued=True))
-    callit(['make']+make_opts, opt.verbose, True, node_src_dir, env)
+    build_time += build_node(node_src_dir, build_system, make_opts, opt, env)
     logger.info('.', extra=dict(continued=True))
     callit(['make install'], opt.verbose, True, node_src_dir, env)
 
     logger.info(' done.')
+    logger.info(' * Built node.js with %s in %.1fs', build_system, build_time)
+
+def use_node_version(env_dir, version, opt):
+    """
+    Makes ``version`` the active node.js of a side by side environment.
+    ``current`` is replaced with a rename of a new symlink, so the switch
+    is atomic; ``bin/`` and ``lib/node_modules`` resolve through it.
+    """
+    version_dir = join(env_dir, 'versions', version)
+    if not os.path.isdir(version_dir):
+        raise NodeenvError('node.js %s is not installed in %s'
+                           % (version, env_dir))
+
+    current = join(env_dir, 'current')
+    tmp_link = '%s.%d.%d' % (current, os.getpid(),
+                              threading.current_thread().ident)
+    os.symlink(join('versions', version), tmp_link)
+    os.rename(tmp_link, current)
+
+    # links through ``current`` only have to be created once per name
+    mkdir(join(version_dir, 'lib', 'node_modules'))
+    mkdir(join(env_dir, 'lib'))
+    mod_dir = join(env_dir, 'lib', 'node_modules')
+    if not os.path.lexists(mod_dir):
+        os.symlink(join('..', 'current', 'lib', 'node_modules'), mod_dir)
+    elif not os.path.islink(mod_dir):
+        logger.warning(' * %s is not a link to the active version', mod_dir)
+
+    bin_dir = get_bin_dir(opt, env_dir)
+    mkdir(bin_dir)
+    version_bin_dir = join(version_dir, 'bin')
+    if os.path.isdir(version_bin_dir):
+        for name in os.listdir(version_bin_dir):
+            link = join(bin_dir, name)
+            if not os.path.lexists(link):
+                os.symlink(join('..', 'current', 'bin', name), link)
+
+    logger.info(' * Using node.js %s', version)
+
 
 def install_npm_win(env_dir, opt):
     """
@@ -522,20 +1187,64 @@ def install_npm_win(env_dir, opt):
 
 def install_npm(env_dir, src_dir, opt):
     """
-    Download source code for npm, unpack it
-    and install it in virtual environment.
+    Install npm into the virtual environment from its registry tarball,
+    kept in the download cache, and link its executables into bin.
     """
     if is_windows_nt:
         return install_npm_win(env_dir, opt)
 
     logger.info(' * Install npm.js (%s) ... ' % opt.npm,
                     extra=dict(continued=True))
-    cmd = ['. %s && curl --silent %s | clean=%s npm_install=%s bash && deactivate_node' % (
-            pipes.quote(join(env_dir, 'bin', 'activate')),
-            'https://npmjs.org/install.sh',
-            'no' if opt.no_npm_clean else 'yes',
-            opt.npm)]
-    callit(cmd, opt.verbose, True)
+    npm_cache_dir = join(opt.cache_dir, 'npm')
+    document = get_registry_document('npm', join(npm_cache_dir, 'index.json'))
+    version = document.get('dist-tags', {}).get(opt.npm)
+    if version is None:
+        version = max_satisfying(list(document['versions']), opt.npm)
+    if version is None:
+        raise NodeenvError('No npm version matches %s' % opt.npm)
+    if version != opt.npm:
+        logger.info('installing v%s... ', version, extra=dict(continued=True))
+
+    tarball = join(npm_cache_dir, 'npm-%s.tgz' % version)
+    download_dist(document['versions'][version]['dist'], tarball)
+
+    mod_dir = get_mod_dir(opt, env_dir)
+    bin_dir = get_bin_dir(opt, env_dir)
+    mkdir(mod_dir)
+    mkdir(bin_dir)
+    npm_dir = join(mod_dir, 'npm')
+    unpack_dir = tempfile.mkdtemp(prefix='.npm-', dir=mod_dir)
+    try:
+        with tarfile.open(tarball, 'r:gz') as tar:
+            members = [m for m in tar.getmembers()
+                       if m.name.startswith('package/') and
+                       '..' not in m.name.split('/') and
+                       (m.isreg() or m.isdir() or m.issym())]
+            tar.extractall(unpack_dir, members)
+        package_dir = join(unpack_dir, 'package')
+        with open(join(package_dir, 'package.json')) as f:
+            package = json.load(f)
+
+        # with --no-npm-clean a previous npm is only replaced file by file
+        if os.path.isdir(npm_dir) and opt.no_npm_clean:
+            copy_tree(package_dir, npm_dir, preserve_symlinks=True)
+        else:
+            if os.path.isdir(npm_dir):
+                shutil.rmtree(npm_dir)
+            os.rename(package_dir, npm_dir)
+    finally:
+        shutil.rmtree(unpack_dir, ignore_errors=True)
+
+    bins = package.get('bin', {})
+    if not isinstance(bins, dict):
+        bins = {'npm': bins}
+    for name, rel_path in bins.items():
+        target = os.path.normpath(join(npm_dir, rel_path))
+        os.chmod(target, os.stat(target).st_mode | 0o111)
+        link = join(bin_dir, name)
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(os.path.relpath(target, bin_dir), link)
     logger.info('done.')
 
 def install_packages_win(env_dir, opt):
@@ -567,27 +1276,97 @@ def install_packages(env_dir, opt):
     if is_windows_nt:
         return install_packages_win(env_dir, opt)
 
+    if opt.package_mirror:
+        return install_packages_from_mirror(env_dir, opt)
+
     logger.info(' * Install node.js packages ... ',
         extra=dict(continued=True))
     packages = [package.strip() for package in
                     open(opt.requirements).readlines()]
-    activate_path = join(env_dir, 'bin', 'activate')
+    env = get_env_vars(env_dir, opt)
     real_npm_ver = opt.npm if opt.npm.count(".") == 2 else opt.npm + ".0"
     if opt.npm == "latest" or real_npm_ver >= "1.0.0":
-        cmd = '. ' + pipes.quote(activate_path) + \
-                ' && npm install -g %(pack)s'
+        cmds = [['npm', 'install', '-g']]
     else:
-        cmd = '. ' + pipes.quote(activate_path) + \
-                ' && npm install %(pack)s' + \
-                ' && npm activate %(pack)s'
+        cmds = [['npm', 'install'], ['npm', 'activate']]
 
     for package in packages:
-        callit(cmd=[cmd % {"pack": package}],
-                show_stdout=opt.verbose, in_shell=True)
+        for cmd in cmds:
+            callit(cmd=cmd + [package], show_stdout=opt.verbose, extra_env=env)
 
     logger.info('done.')
 
 
+# Files installed by node.js and npm, relative to the node prefix, which
+# are not needed at runtime. Only node's own files are listed, as the
+# prefix is shared with a python virtualenv when -p is used.
+SLIM_PRUNE_PATHS = [
+    join('share', 'man', 'man1', 'node.1'),
+    join('share', 'doc', 'node'),
+    join('share', 'systemtap', 'tapset', 'node.stp'),
+    join('lib', 'dtrace', 'node.d'),
+    join('lib', 'node_modules', 'npm', 'doc'),
+    join('lib', 'node_modules', 'npm', 'docs'),
+    join('lib', 'node_modules', 'npm', 'man'),
+    join('lib', 'node_modules', 'npm', 'html'),
+    join('lib', 'node_modules', 'npm', 'changelogs'),
+]
+
+def get_tree_size(path):
+    """
+    Returns the size in bytes of the file or directory tree ``path``
+    """
+    if os.path.islink(path) or not os.path.isdir(path):
+        return os.lstat(path).st_size
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            size += os.lstat(join(root, name)).st_size
+    return size
+
+def slim_environment(env_dir, opt):
+    """
+    Strip the installed binaries and remove the files which are not
+    needed at runtime
+    """
+    logger.info(' * Slim environment ... ', extra=dict(continued=True))
+    saved = 0
+
+    prefix = get_node_prefix(opt, env_dir)
+    node_bin = join(prefix, 'bin', 'node')
+    strip = find_executable('strip')
+    if not strip:
+        logger.info('strip not found, node is not stripped ... ',
+                    extra=dict(continued=True))
+    elif os.path.isfile(node_bin) and not os.path.islink(node_bin):
+        size = os.path.getsize(node_bin)
+        callit([strip, node_bin], opt.verbose, False, env_dir)
+        saved += size - os.path.getsize(node_bin)
+
+    prune = list(SLIM_PRUNE_PATHS)
+    if not opt.keep_headers:
+        prune.append(join('include', 'node'))
+    for rel_path in prune:
+        path = join(prefix, rel_path)
+        if not os.path.lexists(path):
+            continue
+        logger.debug(' * Removing %s', path)
+        saved += get_tree_size(path)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        # drop the directories left empty, up to the prefix
+        parent = os.path.dirname(path)
+        while parent != prefix and os.path.isdir(parent) \
+                and not os.listdir(parent):
+            os.rmdir(parent)
+            parent = os.path.dirname(parent)
+
+    logger.info('saved %.1f MB.', saved / 1024.0 / 1024.0)
+    return saved
+
+
 def install_activate(env_dir, opt):
     """
     Install virtual environment activation script
@@ -615,14 +1394,127 @@ def install_activate(env_dir, opt):
         os.chmod(file_path, mode_0755)
 
 
+EnvironmentInfo = collections.namedtuple(
+    'EnvironmentInfo', ['env_dir', 'node', 'bin_dir', 'mod_dir', 'options'])
+
+
+def check_options(opt):
+    """
+    Checks that the options can be used on the current platform
+    """
+    if opt.build_profile not in BUILD_PROFILES:
+        raise NodeenvError('Unknown build profile: %s' % opt.build_profile)
+    if opt.features not in FEATURE_PRESETS:
+        raise NodeenvError('Unknown features: %s' % opt.features)
+    if is_windows_nt:
+        if opt.without_ssl:
+            raise NotImplementedError('Installing node from source is not '
+                                      'supported for Windows, therefore the '
+                                      '--without-ssl argument is invalid.')
+        if opt.debug:
+            raise NotImplementedError('Installing node from source is not '
+                                      'supported for Windows, therefore the '
+                                      '--debug argument is invalid.')
+        if opt.features != 'full':
+            raise NotImplementedError('Installing node from source is not '
+                                      'supported for Windows, therefore the '
+                                      '--features argument is invalid.')
+        if opt.build_system != 'auto':
+            raise NotImplementedError('Installing node from source is not '
+                                      'supported for Windows, therefore the '
+                                      '--build-system argument is invalid.')
+        if opt.build_profile != 'default':
+            raise NotImplementedError('Installing node from source is not '
+                                      'supported for Windows, therefore the '
+                                      '--build-profile argument is invalid.')
+        if opt.side_by_side or opt.use:
+            raise NotImplementedError('Side by side node.js versions are not '
+                                      'supported for Windows.')
+        if opt.package_mirror:
+            raise NotImplementedError('Installing packages from a mirror is '
+                                      'not supported for Windows.')
+        if opt.slim:
+            raise NotImplementedError('Installing node from source is not '
+                                      'supported for Windows, therefore the '
+                                      '--slim argument is invalid.')
+        if opt.load_average:
+            raise NotImplementedError('Installing node from source is not '
+                                      'supported for Windows, therefore the '
+                                      '--load-average argument is invalid.')
+        if opt.clean_src:
+            raise NotImplementedError('Installing node from source is not '
+                                      'supported for Windows, therefore the '
+                                      '--clean-src argument is invalid.')
+        if not opt.python_virtualenv:
+            raise NotImplementedError('Using nodeenv on Windows is not '
+                                      'supported without an existing Python '
+                                      'virtualenv.')
+
+    if opt.node != 'system' and sys.version_info[0] > 2 and not is_windows_nt:
+        raise NodeenvError('Python 3.x detected. The node.js build system '
+                           'requires Python 2.6-2.7 to build. Python 3 can '
+                           'only be used with the system version of node.js; '
+                           'specify the -n \'system\' option to use this.')
+
+
 def create_environment(env_dir, opt):
     """
     Creates a new environment in ``env_dir``.
+
+    ``opt`` is an options object as returned by ``make_options()`` or
+    ``parse_args()``; it is not modified. Returns an ``EnvironmentInfo``
+    and raises ``NodeenvError`` (or ``OSError`` for failed commands)
+    instead of exiting, so it can be called from other Python code,
+    concurrently from several threads for distinct ``env_dir``.
+
+    New environments are built in a staging directory next to ``env_dir``
+    and linked into place when complete. Existing python virtualenvs, side
+    by side environments and directories not built that way are completed
+    in place, under a lock.
+    """
+    opt = copy.copy(opt)
+    check_options(opt)
+
+    if opt.node is None:
+        opt.node = get_last_stable_node_version()
+    if opt.side_by_side and opt.node == "system":
+        raise NodeenvError('The system node.js can not be installed side by side')
+
+    if opt.python_virtualenv or (os.path.lexists(env_dir) and
+            (opt.side_by_side or not is_staged_environment(env_dir))):
+        with FileLock(get_lock_path(env_dir)):
+            if not opt.python_virtualenv:
+                if not opt.force:
+                    raise NodeenvError('Environment already exists: %s' % env_dir)
+                logger.info(' * Environment already exists: %s', env_dir)
+            install_environment(env_dir, opt)
+    else:
+        # the prompt must not be derived from the staging directory name
+        opt.prompt = opt.prompt or '(%s)' % os.path.basename(abspath(env_dir))
+
+        def build(staging_dir):
+            # keep the downloaded sources of the environment being replaced
+            old_src_dir = join(env_dir, 'src')
+            new_src_dir = join(staging_dir, 'src')
+            if os.path.isdir(old_src_dir):
+                os.rename(old_src_dir, new_src_dir)
+            try:
+                install_environment(staging_dir, opt)
+            except BaseException:
+                if os.path.isdir(new_src_dir) and not os.path.exists(old_src_dir) \
+                        and os.path.isdir(env_dir):
+                    os.rename(new_src_dir, old_src_dir)
+                raise
+        build_staged(env_dir, opt, build)
+
+    return EnvironmentInfo(abspath(env_dir), opt.node,
+                           get_bin_dir(opt, abspath(env_dir)),
+                           get_mod_dir(opt, abspath(env_dir)), opt)
+
+def install_environment(env_dir, opt):
+    """
+    Installs node.js, npm and the packages into ``env_dir``
     """
-    if os.path.exists(env_dir) and not opt.python_virtualenv:
-        logger.info(' * Environment already exists: %s', env_dir)
-        if not opt.force:
-            sys.exit(2)
     if is_windows_nt:
         src_dir = None
     else:
@@ -630,10 +1522,10 @@ def create_environment(env_dir, opt):
         mkdir(src_dir)
     save_env_options(env_dir, opt)
 
-    if opt.node is None:
-        opt.node = get_last_stable_node_version()
     if opt.node != "system":
         install_node(env_dir, src_dir, opt)
+        if opt.side_by_side:
+            use_node_version(env_dir, opt.node, opt)
     else:
         if not is_windows_nt:
             mkdir(get_bin_dir(opt, env_dir))
@@ -644,14 +1536,243 @@ def create_environment(env_dir, opt):
     # before npm install, npm use activate
     # for install
     install_activate(env_dir, opt)
-    if parse_version(opt.node) < parse_version("0.6.3") or opt.with_npm or is_windows_nt:
+    without_npm = opt.node != "system" and \
+        not FEATURE_PRESETS[opt.features].get('npm', True)
+    if parse_version(opt.node) < parse_version("0.6.3") or opt.with_npm \
+            or without_npm or is_windows_nt:
         install_npm(env_dir, src_dir, opt)
     if opt.requirements:
         install_packages(env_dir, opt)
+    if opt.slim:
+        slim_environment(env_dir, opt)
     # Cleanup
     if opt.clean_src and not is_windows_nt:
         callit(['rm -rf', pipes.quote(src_dir)], opt.verbose, True, env_dir)
 
+def get_lock_path(env_dir):
+    """
+    Returns the path of the lock file guarding ``env_dir``. It is kept
+    next to the environment, so every process writing to it, whatever
+    its user or ``--cache-dir``, uses the same lock, and it outlives the
+    environment being replaced.
+    """
+    parent, name = os.path.split(abspath(env_dir))
+    parent = os.path.realpath(parent)
+    mkdir(parent)
+    return join(parent, '.%s.nodeenv-lock' % name)
+
+def make_unique_dir(parent, prefix):
+    """
+    Creates a new directory named ``prefix`` plus a random suffix in
+    ``parent``. Unlike ``tempfile.mkdtemp()`` the mode follows the umask,
+    as for any other directory of the environment.
+    """
+    while True:
+        path = join(parent, prefix + uuid.uuid4().hex[:8])
+        try:
+            os.mkdir(path, 0o777)
+            return path
+        except OSError:
+            if not os.path.exists(path):
+                raise
+
+def is_staged_environment(env_dir):
+    """
+    Tells whether ``env_dir`` is a link to a tree built by ``build_staged()``
+    """
+    if not os.path.islink(env_dir):
+        return False
+    name = os.path.basename(abspath(env_dir))
+    target = os.readlink(env_dir)
+    return target.startswith('.%s.tree-' % name) and os.sep not in target \
+        and os.path.isdir(env_dir)
+
+def build_staged(env_dir, opt, build):
+    """
+    Calls ``build(staging_dir)`` with a new directory next to ``env_dir``
+    and, once it is complete, makes ``env_dir`` a link to the result. A
+    failed or interrupted build leaves ``env_dir`` untouched, and an
+    environment built this way is replaced by flipping the link, so
+    rebuilding it never leaves ``env_dir`` missing or half built.
+
+    Only environments built this way are replaced; nodeenv does not know
+    which files of any other existing directory are its own.
+    """
+    env_dir = abspath(env_dir)
+    parent, name = os.path.split(env_dir)
+    mkdir(parent)
+    with FileLock(get_lock_path(env_dir)):
+        if os.path.lexists(env_dir):
+            if not opt.force:
+                raise NodeenvError('Environment already exists: %s' % env_dir)
+            if not is_staged_environment(env_dir):
+                raise NodeenvError('%s was not built by nodeenv in a staging '
+                                   'directory and can not be replaced; '
+                                   'remove it first' % env_dir)
+            logger.info(' * Environment already exists: %s', env_dir)
+
+        remove_old_trees(env_dir)
+        staging_dir = make_unique_dir(parent, '.%s.staging-' % name)
+        try:
+            build(staging_dir)
+            relocate_environment(staging_dir, staging_dir, opt, env_dir)
+        except BaseException:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+        tree_dir = join(parent, '.%s.tree-%s' % (name, staging_dir.rsplit('-', 1)[1]))
+        os.rename(staging_dir, tree_dir)
+        link_environment(tree_dir, env_dir)
+
+def link_environment(tree_dir, env_dir):
+    """
+    Points the ``env_dir`` link to ``tree_dir`` with the rename of a new
+    link, so processes see either the old or the new tree. The old tree
+    is left in place for processes still using it and removed by
+    ``remove_old_trees()`` when the environment is rebuilt again.
+    """
+    tmp_link = '%s.%d.%d' % (tree_dir, os.getpid(),
+                              threading.current_thread().ident)
+    os.symlink(os.path.basename(tree_dir), tmp_link)
+    os.rename(tmp_link, env_dir)
+
+def remove_old_trees(env_dir):
+    """
+    Removes the trees nodeenv left next to ``env_dir`` by earlier builds:
+    replaced environments and staging directories of interrupted builds.
+    The tree ``env_dir`` links to is kept. Must be called with the
+    environment locked.
+    """
+    parent, name = os.path.split(env_dir)
+    current = None
+    if os.path.islink(env_dir):
+        current = os.path.realpath(env_dir)
+    for entry in os.listdir(parent):
+        if not (entry.startswith('.%s.tree-' % name) or
+                entry.startswith('.%s.staging-' % name)):
+            continue
+        path = join(parent, entry)
+        if os.path.islink(path):
+            # a link of an interrupted link_environment()
+            os.remove(path)
+            continue
+        if not os.path.isdir(path) or os.path.realpath(path) == current:
+            continue
+        logger.debug(' * Removing old tree %s', path)
+        shutil.rmtree(path, ignore_errors=True)
+
+def relocate_environment(env_dir, old_env_dir, opt, new_env_dir=None):
+    """
+    Rewrites the absolute paths of ``old_env_dir`` baked into the scripts
+    and symlinks of the bin directory of ``env_dir`` to ``new_env_dir``
+    (``env_dir`` itself by default)
+    """
+    old_path = abspath(old_env_dir)
+    new_path = abspath(new_env_dir or env_dir)
+    if old_path == new_path:
+        return
+    bin_dir = get_bin_dir(opt, env_dir)
+    if not os.path.isdir(bin_dir):
+        return
+
+    for name in os.listdir(bin_dir):
+        path = join(bin_dir, name)
+        if os.path.islink(path):
+            target = os.readlink(path)
+            if target == old_path or target.startswith(old_path + os.sep):
+                os.remove(path)
+                os.symlink(new_path + target[len(old_path):], path)
+            continue
+        if not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            content = f.read()
+        # skip binaries, e.g. the node executable itself
+        if b'\0' in content[:1024] or old_path.encode('utf-8') not in content:
+            continue
+        logger.debug(' * Relocating %s', path)
+        content = content.replace(old_path.encode('utf-8'),
+                                  new_path.encode('utf-8'))
+        with open(path, 'wb') as f:
+            f.write(content)
+
+
+def clone_environment(src_env_dir, env_dir, opt):
+    """
+    Creates a new environment in ``env_dir`` as a copy of the already
+    built ``src_env_dir``, without its sources. Packages from
+    ``opt.requirements`` are installed on top of the copy.
+    """
+    opt = copy.copy(opt)
+    if not os.path.isdir(src_env_dir):
+        raise NodeenvError('Environment does not exist: %s' % src_env_dir)
+    opt.prompt = opt.prompt or '(%s)' % os.path.basename(abspath(env_dir))
+
+    logger.info(' * Clone environment %s ... ', src_env_dir,
+                extra=dict(continued=True))
+    src_root = abspath(src_env_dir)
+
+    def ignore_src(path, names):
+        if abspath(path) == src_root and 'src' in names:
+            return ['src']
+        return []
+
+    def build(staging_dir):
+        os.rmdir(staging_dir)
+        shutil.copytree(src_env_dir, staging_dir, symlinks=True, ignore=ignore_src)
+        relocate_environment(staging_dir, src_env_dir, opt)
+
+        # activate script carries the prompt of the source environment
+        activate_path = join(get_bin_dir(opt, staging_dir),
+                             'node.bat' if is_windows_nt else 'activate')
+        if os.path.exists(activate_path):
+            os.remove(activate_path)
+        install_activate(staging_dir, opt)
+
+        if opt.requirements:
+            install_packages(staging_dir, opt)
+    build_staged(env_dir, opt, build)
+    logger.info('done.')
+
+    return EnvironmentInfo(abspath(env_dir), opt.node,
+                           get_bin_dir(opt, abspath(env_dir)),
+                           get_mod_dir(opt, abspath(env_dir)), opt)
+
+
+def update_environment(env_dir, opt):
+    """
+    Installs npm (if ``opt.with_npm``) and the packages from
+    ``opt.requirements`` into the existing environment ``env_dir``.
+    """
+    opt = copy.copy(opt)
+    if not os.path.isdir(env_dir):
+        raise NodeenvError('Environment does not exist: %s' % env_dir)
+
+    with FileLock(get_lock_path(env_dir)):
+        if opt.with_npm:
+            install_npm(env_dir, join(env_dir, 'src'), opt)
+        if opt.requirements:
+            install_packages(env_dir, opt)
+
+    return EnvironmentInfo(abspath(env_dir), opt.node,
+                           get_bin_dir(opt, abspath(env_dir)),
+                           get_mod_dir(opt, abspath(env_dir)), opt)
+
+def exec_in_environment(env_dir, cmd, opt):
+    """
+    Replaces the current process with ``cmd`` run inside the environment
+    """
+    if not os.path.isdir(env_dir):
+        raise NodeenvError('Environment does not exist: %s' % env_dir)
+    env = os.environ.copy()
+    env.update(get_env_vars(env_dir, opt))
+    if is_windows_nt:
+        sys.exit(subprocess.call(cmd, env=env, shell=True))
+    try:
+        os.execvpe(cmd[0], cmd, env)
+    except OSError:
+        e = sys.exc_info()[1]
+        raise NodeenvError('Could not run %s: %s' % (cmd[0], e.strerror))
+
 def print_node_versions_win():
     """
     Prints into stdout all available node.js versions for Windows.
@@ -719,7 +1840,7 @@ def get_last_stable_node_version():
     if m:
         return m.group(1)
     else:
-        raise "<unknown>"
+        raise NodeenvError('Could not determine the last stable node.js version')
 
 def save_env_options(env_dir, opt, file_path='install.cfg'):
     """
@@ -731,59 +1852,1066 @@ def save_env_options(env_dir, opt, file_path='install.cfg'):
     for o, v in opt.__dict__.items():
         config.set(section_name, o, v)
 
+    config.add_section('features')
+    config.set('features', 'name', opt.features)
+    config.set('features', 'configure',
+               ' '.join(FEATURE_PRESETS[opt.features]['configure']))
+
+    profile = BUILD_PROFILES[opt.build_profile]
+    config.add_section('build_profile')
+    config.set('build_profile', 'name', opt.build_profile)
+    config.set('build_profile', 'configure', ' '.join(profile['configure']))
+    config.set('build_profile', 'pgo', bool(profile.get('pgo')))
+    for var, flags in sorted(get_build_profile_env(opt.build_profile).items()):
+        config.set('build_profile', var.lower(), flags)
+
     with open(join(env_dir, file_path), 'w') as configfile:
         config.write(configfile)
 
 
+# ---------------------------------------------------------
+# Environment archives
+
+MANIFEST_NAME = '.nodeenv-manifest.json'
+
+
+class HashingReader(object):
+    """
+    File wrapper which computes the sha256 of the data read through it
+    """
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha256.update(data)
+        return data
+
+
+def get_archive_compressor(archive_path, decompress=False):
+    """
+    Returns the command of the external compressor to use for
+    ``archive_path``, or None if python's gzip should be used
+    """
+    if archive_path.endswith(('.tar.zst', '.tzst')):
+        if not find_executable('zstd'):
+            raise NodeenvError('zstd is required for %s' % archive_path)
+        if decompress:
+            return ['zstd', '-d', '-q', '-c']
+        return ['zstd', '-T0', '-q', '-c']
+    if archive_path.endswith(('.tar.gz', '.tgz')):
+        # pigz compresses with all cores, gzip module only with one
+        if find_executable('pigz'):
+            return ['pigz', '-d', '-c'] if decompress else ['pigz', '-c']
+        return None
+    raise NodeenvError('Unknown archive type: %s '
+                       '(use .tar.zst or .tar.gz)' % archive_path)
+
+
+def pack_environment(env_dir, archive_path):
+    """
+    Streams ``env_dir``, without its sources, into a compressed
+    ``archive_path`` with a manifest of the file hashes
+    """
+    if not os.path.isdir(env_dir):
+        raise NodeenvError('Environment does not exist: %s' % env_dir)
+    logger.info(' * Pack environment %s into %s ... ', env_dir, archive_path,
+                extra=dict(continued=True))
+
+    compressor = get_archive_compressor(archive_path)
+    out = open(archive_path, 'wb')
+    proc = None
+    try:
+        if compressor:
+            proc = subprocess.Popen(compressor, stdin=subprocess.PIPE,
+                                    stdout=out)
+            tar = tarfile.open(fileobj=proc.stdin, mode='w|')
+        else:
+            tar = tarfile.open(fileobj=out, mode='w|gz')
+
+        hashes = {}
+        env_root = abspath(env_dir)
+        for root, dirs, files in os.walk(env_root):
+            if root == env_root and 'src' in dirs:
+                dirs.remove('src')
+            dirs.sort()
+            for name in dirs + sorted(files):
+                path = join(root, name)
+                arcname = os.path.relpath(path, env_root)
+                if arcname == MANIFEST_NAME:
+                    continue
+                info = tar.gettarinfo(path, arcname)
+                if info is None or not (info.isreg() or info.isdir() or
+                                        info.issym() or info.islnk()):
+                    # FIFOs, sockets and devices can not be restored
+                    logger.warning(' * Skipping special file %s', path)
+                    continue
+                if info.islnk():
+                    # hardlinks are stored as plain copies, so that every
+                    # file is hashed and restored on its own
+                    info.type = tarfile.REGTYPE
+                    info.linkname = ''
+                    info.size = os.path.getsize(path)
+                if info.isreg():
+                    with open(path, 'rb') as f:
+                        reader = HashingReader(f)
+                        tar.addfile(info, reader)
+                    hashes[arcname] = reader.sha256.hexdigest()
+                else:
+                    tar.addfile(info)
+
+        manifest = json.dumps({
+            'nodeenv_version': nodeenv_version,
+            'env_dir': env_root,
+            'files': hashes,
+        }, indent=2, sort_keys=True).encode('utf-8')
+        info = tarfile.TarInfo(MANIFEST_NAME)
+        info.size = len(manifest)
+        info.mtime = time.time()
+        tar.addfile(info, io.BytesIO(manifest))
+        tar.close()
+    finally:
+        if proc:
+            proc.stdin.close()
+            proc.wait()
+        out.close()
+    if proc and proc.returncode:
+        raise OSError('Command %s failed with error code %s'
+                      % (' '.join(compressor), proc.returncode))
+    logger.info('done.')
+
+
+def unpack_environment(archive_path, env_dir, opt):
+    """
+    Restores an environment packed by ``pack_environment()`` into
+    ``env_dir``, checks the file hashes and relocates the scripts
+    """
+    if not os.path.isfile(archive_path):
+        raise NodeenvError('Archive does not exist: %s' % archive_path)
+    logger.info(' * Unpack %s into %s ... ', archive_path, env_dir,
+                extra=dict(continued=True))
+    build_staged(env_dir, opt,
+                 lambda staging_dir: extract_environment(archive_path,
+                                                         staging_dir, opt))
+    logger.info('done.')
+
+
+def extract_environment(archive_path, env_dir, opt):
+    """
+    Extracts the archive into the existing directory ``env_dir``
+    """
+    decompressor = get_archive_compressor(archive_path, decompress=True)
+    src = open(archive_path, 'rb')
+    proc = None
+    manifest = None
+    hashes = {}
+    env_root = abspath(env_dir)
+    try:
+        if decompressor:
+            proc = subprocess.Popen(decompressor, stdin=src,
+                                    stdout=subprocess.PIPE)
+            tar = tarfile.open(fileobj=proc.stdout, mode='r|')
+        else:
+            tar = tarfile.open(fileobj=src, mode='r|gz')
+
+        real_root = os.path.realpath(env_root)
+        directories = []
+        for member in tar:
+            path = abspath(join(env_root, member.name))
+            # resolving the parent catches symlinks extracted earlier
+            # which point outside of the environment
+            real_parent = os.path.realpath(os.path.dirname(path))
+            if not path.startswith(env_root + os.sep) or \
+                    not (real_parent + os.sep).startswith(real_root + os.sep):
+                raise NodeenvError('Unsafe path in archive: %s' % member.name)
+            if os.path.islink(path):
+                os.remove(path)
+            if member.name == MANIFEST_NAME:
+                manifest = json.loads(tar.extractfile(member).read().decode('utf-8'))
+            elif member.isdir():
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                directories.append((path, member))
+            elif member.issym():
+                os.symlink(member.linkname, path)
+            elif member.isreg():
+                reader = HashingReader(tar.extractfile(member))
+                with open(path, 'wb') as f:
+                    shutil.copyfileobj(reader, f, 1024 * 1024)
+                os.chmod(path, member.mode)
+                os.utime(path, (member.mtime, member.mtime))
+                hashes[member.name] = reader.sha256.hexdigest()
+            else:
+                raise NodeenvError('Unsupported member in archive: %s'
+                                   % member.name)
+        tar.close()
+
+        # as in tarfile.extractall(), only once their files are written,
+        # so read-only directories can be restored
+        for path, member in sorted(directories, key=lambda d: d[0],
+                                   reverse=True):
+            os.chmod(path, member.mode)
+            os.utime(path, (member.mtime, member.mtime))
+    finally:
+        if proc:
+            proc.stdout.close()
+            proc.wait()
+        src.close()
+    if proc and proc.returncode:
+        raise OSError('Command %s failed with error code %s'
+                      % (' '.join(decompressor), proc.returncode))
+
+    if manifest is None:
+        raise NodeenvError('No manifest in %s' % archive_path)
+    if hashes != manifest['files']:
+        raise NodeenvError('Files of %s do not match its manifest' % archive_path)
+    relocate_environment(env_root, manifest['env_dir'], opt)
+
+
+# ---------------------------------------------------------
+# Package mirror
+
+NPM_REGISTRY = os.environ.get('NPM_CONFIG_REGISTRY', 'https://registry.npmjs.org/')
+
+# Fields of a version in the abbreviated registry document which npm uses
+# to build the dependency tree; the mirror serves them unchanged
+MANIFEST_FIELDS = ['dependencies', 'optionalDependencies', 'peerDependencies',
+                   'peerDependenciesMeta', 'bundleDependencies', 'bin',
+                   'directories', 'engines', 'os', 'cpu', 'hasInstallScript',
+                   'deprecated']
+
+SEMVER_RE = re.compile(r'^v?(\d+)\.(\d+)\.(\d+)(?:-([0-9A-Za-z.\-]+))?(?:\+[0-9A-Za-z.\-]+)?$')
+PARTIAL_RE = re.compile(r'^v?([0-9xX*]+)(?:\.([0-9xX*]+))?(?:\.([0-9xX*]+))?'
+                        r'(?:-([0-9A-Za-z.\-]+))?(?:\+[0-9A-Za-z.\-]+)?$')
+COMPARATOR_RE = re.compile(r'^(<=|>=|<|>|=|\^|~>|~)?\s*(.*)$')
+
+
+def parse_semver(version):
+    """
+    Returns a sortable key for a semver ``version``, or None if it is not
+    a valid version. Pre-releases sort before their release.
+    """
+    m = SEMVER_RE.match(version.strip())
+    if not m:
+        return None
+    major, minor, patch, pre = m.groups()
+    if pre is None:
+        pre_key = (1,)
+    else:
+        pre_key = (0,) + tuple((0, int(p), '') if p.isdigit() else (1, 0, p)
+                               for p in pre.split('.'))
+    return (int(major), int(minor), int(patch), pre_key)
+
+
+def expand_comparator(comparator):
+    """
+    Expands one range comparator (``^1.2``, ``~1.2.3``, ``>=1``, ``1.x``)
+    into a list of ``(operator, key)`` pairs
+    """
+    m = COMPARATOR_RE.match(comparator)
+    op, version = m.group(1) or '', m.group(2)
+    if version in ('', '*', 'x', 'X', 'latest'):
+        return []
+    pm = PARTIAL_RE.match(version)
+    if not pm:
+        raise NodeenvError('Invalid version range: %s' % comparator)
+    parts = []
+    for part in pm.groups()[:3]:
+        if part is None or part in ('x', 'X', '*'):
+            break
+        parts.append(int(part))
+    pre = pm.group(4)
+    if op == '~>':
+        op = '~'
+
+    def key(major, minor=0, patch=0, pre=None):
+        return parse_semver('%d.%d.%d%s' % (major, minor, patch,
+                                             '-' + pre if pre else ''))
+
+    if not parts:
+        return []
+    low = key(*(parts + [0] * (3 - len(parts))), pre=pre)
+    if op in ('', '=') and len(parts) == 3:
+        return [('=', low)]
+    if op == '^':
+        if parts[0] > 0 or len(parts) == 1:
+            high = key(parts[0] + 1)
+        elif parts[1] > 0 or len(parts) == 2:
+            high = key(0, parts[1] + 1)
+        else:
+            high = key(0, 0, parts[2] + 1)
+        return [('>=', low), ('<', high)]
+    if op in ('~', '', '='):
+        if len(parts) == 1:
+            high = key(parts[0] + 1)
+        else:
+            high = key(parts[0], parts[1] + 1)
+        return [('>=', low), ('<', high)]
+    if op == '>=' or op == '<':
+        return [(op, low)]
+    if len(parts) == 3:
+        return [(op, low)]
+    # partial versions in '>' and '<=' cover the whole partial range
+    bumped = key(*(parts[:-1] + [parts[-1] + 1]))
+    return [('>=' if op == '>' else '<', bumped)]
+
+
+def parse_range(spec):
+    """
+    Parses a semver range into a list of alternative comparator lists
+    """
+    alternatives = []
+    for alternative in spec.split('||'):
+        alternative = alternative.strip()
+        hyphen = re.match(r'^(\S+)\s+-\s+(\S+)$', alternative)
+        if hyphen:
+            comparators = expand_comparator('>=' + hyphen.group(1))
+            upper = expand_comparator('<=' + hyphen.group(2))
+            alternatives.append(comparators + upper)
+            continue
+        # '>= 1.2' is written with a space as often as without
+        alternative = re.sub(r'(<=|>=|<|>|=|\^|~>|~)\s+', r'\1', alternative)
+        comparators = []
+        for comparator in alternative.split():
+            comparators.extend(expand_comparator(comparator))
+        alternatives.append(comparators)
+    return alternatives
+
+
+def max_satisfying(versions, spec):
+    """
+    Returns the highest of ``versions`` matching the semver range ``spec``.
+    Pre-releases are only matched exactly.
+    """
+    if spec.strip() in versions:
+        return spec.strip()
+    alternatives = parse_range(spec)
+    best = None
+    best_key = None
+    for version in versions:
+        version_key = parse_semver(version)
+        if version_key is None or version_key[3] != (1,):
+            continue
+        for comparators in alternatives:
+            for op, bound in comparators:
+                if not {'=': version_key == bound,
+                        '>=': version_key >= bound,
+                        '>': version_key > bound,
+                        '<=': version_key <= bound,
+                        '<': version_key < bound}[op]:
+                    break
+            else:
+                if best_key is None or version_key > best_key:
+                    best, best_key = version, version_key
+                break
+    return best
+
+
+def parse_requirement(requirement):
+    """
+    Splits a requirements file line into package name and version range
+    """
+    requirement = requirement.strip()
+    if requirement.startswith('@'):
+        name, sep, spec = requirement[1:].partition('@')
+        name = '@' + name
+    else:
+        name, sep, spec = requirement.partition('@')
+    if '/' in name and not name.startswith('@') or ':' in requirement:
+        raise NodeenvError('Only registry packages can be prefetched: %s'
+                           % requirement)
+    return name, spec.strip() or 'latest'
+
+
+def get_tarball_name(name, version):
+    # the scope stays in the name, so @types/node and types-node differ
+    return '%s-%s.tgz' % (urllib.quote(name, safe='@'), version)
+
+
+def check_integrity(path, dist):
+    """
+    Checks the file at ``path`` against the hashes of a registry ``dist``
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    integrity = dist.get('integrity', '')
+    if integrity.startswith('sha512-'):
+        digest = base64.b64encode(hashlib.sha512(data).digest())
+        return digest.decode('ascii') == integrity[len('sha512-'):]
+    if dist.get('shasum'):
+        return hashlib.sha1(data).hexdigest() == dist['shasum']
+    return True
+
+
+def download_dist(dist, path):
+    """
+    Downloads the tarball of a registry ``dist`` to ``path``, unless a file
+    with the right hashes is already there
+    """
+    if os.path.exists(path) and check_integrity(path, dist):
+        return
+    logger.debug(' * Downloading %s', dist['tarball'])
+    fd, part_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                     prefix=os.path.basename(path) + '.')
+    r = None
+    try:
+        r = urllib.urlopen(dist['tarball'])
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(r, f)
+        if not check_integrity(part_path, dist):
+            raise NodeenvError('Checksum mismatch for %s' % dist['tarball'])
+        os.rename(part_path, path)
+    finally:
+        if r: r.close()
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+
+def fetch_registry_document(name):
+    """
+    Returns the abbreviated registry document of the package ``name``
+    as a JSON string
+    """
+    url = NPM_REGISTRY.rstrip('/') + '/' + urllib.quote(name, safe='@')
+    request = urllib.Request(url, headers={
+        'Accept': 'application/vnd.npm.install-v1+json'})
+    r = None
+    try:
+        r = urllib.urlopen(request)
+        return r.read().decode('utf-8')
+    finally:
+        if r: r.close()
+
+
+def get_registry_document(name, cache_path, max_age=24 * 3600):
+    """
+    Returns the registry document of the package ``name``, cached in
+    ``cache_path``. A stale cache is used if the registry is unreachable.
+    """
+    if os.path.exists(cache_path) and \
+            time.time() - os.path.getmtime(cache_path) < max_age:
+        with open(cache_path) as f:
+            return json.load(f)
+
+    try:
+        data = fetch_registry_document(name)
+    except Exception:
+        if not os.path.exists(cache_path):
+            raise
+        logger.debug(' * Registry unreachable, using cached %s', cache_path)
+        with open(cache_path) as f:
+            return json.load(f)
+
+    mkdir(os.path.dirname(cache_path))
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path))
+    with os.fdopen(fd, 'w') as f:
+        f.write(data)
+    os.rename(tmp_path, cache_path)
+    return json.loads(data)
+
+
+class PackagePrefetcher(object):
+    """
+    Resolves requirements and their dependencies against the registry and
+    downloads the package tarballs with a pool of worker threads
+    """
+    def __init__(self, dest_dir, jobs=8):
+        self.dest_dir = dest_dir
+        self.jobs = jobs
+        self.tasks = queue.Queue()
+        self.lock = threading.Lock()
+        self.metadata = {}
+        self.metadata_locks = {}
+        self.resolved = {}
+        self.packages = {}
+        self.errors = []
+
+    def get_metadata(self, name):
+        with self.lock:
+            name_lock = self.metadata_locks.setdefault(name, threading.Lock())
+        with name_lock:
+            if name not in self.metadata:
+                self.metadata[name] = json.loads(fetch_registry_document(name))
+            return self.metadata[name]
+
+    def resolve(self, name, spec):
+        metadata = self.get_metadata(name)
+        version = metadata.get('dist-tags', {}).get(spec)
+        if version is None:
+            version = max_satisfying(list(metadata['versions']), spec)
+        if version is None:
+            raise NodeenvError('No version of %s matches %s' % (name, spec))
+        with self.lock:
+            self.resolved[(name, spec)] = version
+            package_id = '%s@%s' % (name, version)
+            if package_id in self.packages:
+                return
+            info = metadata['versions'][version]
+            package = dict((field, info[field]) for field in MANIFEST_FIELDS
+                           if field in info)
+            package.update({
+                'name': name,
+                'version': version,
+                'file': get_tarball_name(name, version),
+                'dist': dict((k, v) for k, v in info['dist'].items()
+                             if k in ('shasum', 'integrity')),
+            })
+            self.packages[package_id] = package
+        self.tasks.put((self.download, (package_id, info['dist'])))
+        # npm 7+ installs peer dependencies as well
+        optional = set(info.get('optionalDependencies', {}))
+        optional.update(dep_name for dep_name, meta
+                        in info.get('peerDependenciesMeta', {}).items()
+                        if meta.get('optional'))
+        for field in ('dependencies', 'optionalDependencies', 'peerDependencies'):
+            for dep_name, dep_spec in info.get(field, {}).items():
+                if dep_name in optional:
+                    self.tasks.put((self.resolve_optional, (dep_name, dep_spec)))
+                else:
+                    self.tasks.put((self.resolve, (dep_name, dep_spec)))
+
+    def resolve_optional(self, name, spec):
+        try:
+            self.resolve(name, spec)
+        except Exception:
+            logger.debug(' * Skipping optional package %s@%s: %s',
+                         name, spec, sys.exc_info()[1])
+
+    def download(self, package_id, dist):
+        download_dist(dist, join(self.dest_dir, self.packages[package_id]['file']))
+
+    def worker(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                self.tasks.task_done()
+                return
+            func, args = task
+            try:
+                func(*args)
+            except Exception:
+                e = sys.exc_info()[1]
+                with self.lock:
+                    self.errors.append('%s%r: %s' % (func.__name__, args[:1], e))
+            finally:
+                self.tasks.task_done()
+
+    def run(self, requirements):
+        mkdir(self.dest_dir)
+        for requirement in requirements:
+            self.tasks.put((self.resolve, parse_requirement(requirement)))
+        threads = []
+        for i in range(self.jobs):
+            t = threading.Thread(target=self.worker)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        self.tasks.join()
+        # one sentinel per worker, as each of them exits on the first
+        for t in threads:
+            self.tasks.put(None)
+        for t in threads:
+            t.join()
+        if self.errors:
+            raise NodeenvError('Prefetch failed:\n  ' + '\n  '.join(self.errors))
+
+        index = {
+            'requirements': dict(
+                (requirement, '%s@%s' % (parse_requirement(requirement)[0],
+                                         self.resolved[parse_requirement(requirement)]))
+                for requirement in requirements),
+            'packages': self.packages,
+        }
+        with open(join(self.dest_dir, 'index.json'), 'w') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        return index
+
+
+def read_requirements(file_path):
+    """
+    Returns the non-empty lines of a requirements file
+    """
+    with open(file_path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def prefetch_packages(requirements_path, dest_dir, opt):
+    """
+    Downloads the packages of ``requirements_path`` and their dependencies
+    into ``dest_dir`` and writes its ``index.json``
+    """
+    logger.info(' * Prefetch node.js packages into %s ... ', dest_dir,
+                extra=dict(continued=True))
+    prefetcher = PackagePrefetcher(dest_dir, int(opt.prefetch_jobs))
+    index = prefetcher.run(read_requirements(requirements_path))
+    logger.info('%d packages.', len(index['packages']))
+    return index
+
+
+class MirrorRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves a package mirror as a minimal npm registry: package documents
+    built from ``index.json`` and the tarballs under ``/-/files/``
+    """
+    def do_GET(self):
+        mirror = self.server.mirror
+        path = urllib.unquote(self.path.split('?')[0]).lstrip('/')
+        if path.startswith('-/files/'):
+            file_path = join(mirror['dir'], os.path.basename(path))
+            if not os.path.isfile(file_path):
+                return self.send_error(404)
+            with open(file_path, 'rb') as f:
+                body = f.read()
+            content_type = 'application/octet-stream'
+        else:
+            versions = mirror['names'].get(path)
+            if not versions:
+                return self.send_error(404)
+            base_url = 'http://%s:%d/-/files/' % self.server.server_address
+            document = {'name': path, 'versions': {}}
+            for package in versions:
+                dist = dict(package.get('dist', {}))
+                dist['tarball'] = base_url + urllib.quote(package['file'])
+                manifest = dict((field, package[field])
+                                for field in MANIFEST_FIELDS if field in package)
+                manifest.update({
+                    'name': path,
+                    'version': package['version'],
+                    'dist': dist,
+                })
+                document['versions'][package['version']] = manifest
+            latest = max(document['versions'], key=parse_semver)
+            document['dist-tags'] = {'latest': latest}
+            body = json.dumps(document).encode('utf-8')
+            content_type = 'application/json'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(' * Mirror: ' + format, *args)
+
+
+class MirrorServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def install_packages_from_mirror(env_dir, opt):
+    """
+    Install node.js packages from a directory filled by ``prefetch_packages()``.
+    The directory is served as a registry on the loopback interface for the
+    duration of the install, so npm resolves every dependency from it.
+    """
+    logger.info(' * Install node.js packages from %s ... ', opt.package_mirror,
+                extra=dict(continued=True))
+    with open(join(opt.package_mirror, 'index.json')) as f:
+        index = json.load(f)
+    packages = []
+    for requirement in read_requirements(opt.requirements):
+        if requirement not in index['requirements']:
+            raise NodeenvError('%s is not in the package mirror %s'
+                               % (requirement, opt.package_mirror))
+        packages.append(index['requirements'][requirement])
+
+    names = {}
+    for package in index['packages'].values():
+        names.setdefault(package['name'], []).append(package)
+    server = MirrorServer(('127.0.0.1', 0), MirrorRequestHandler)
+    server.mirror = {'dir': abspath(opt.package_mirror), 'names': names}
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        cmd = ['npm', 'install', '-g', '--no-audit',
+               '--registry=http://%s:%d/' % server.server_address] + packages
+        callit(cmd=cmd, show_stdout=opt.verbose,
+               extra_env=get_env_vars(env_dir, opt))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    logger.info('done.')
+
+
+# ---------------------------------------------------------
+# Benchmarks
+
+BENCHMARKS = ['startup', 'json', 'crypto', 'http']
+
+
+def get_node_executable(env_dir, opt):
+    if is_windows_nt:
+        return join(get_bin_dir(opt, env_dir), 'node-venv.exe')
+    return join(get_bin_dir(opt, env_dir), 'node')
+
+
+def load_env_options(env_dir, file_path='install.cfg'):
+    """
+    Returns the sections of the config file written by
+    ``save_env_options()`` as a dict of dicts
+    """
+    config = ConfigParser.RawConfigParser()
+    config.read(join(env_dir, file_path))
+    return dict((section, dict(config.items(section)))
+                for section in config.sections())
+
+
+def summarize(samples):
+    """
+    Returns the statistics of a list of timings in milliseconds
+    """
+    n = len(samples)
+    ordered = sorted(samples)
+    mean = sum(samples) / float(n)
+    if n % 2:
+        median = ordered[n // 2]
+    else:
+        median = (ordered[n // 2 - 1] + ordered[n // 2]) / 2.0
+    stdev = 0.0
+    if n > 1:
+        stdev = (sum((x - mean) ** 2 for x in samples) / (n - 1)) ** 0.5
+    return {'runs': n, 'median': median, 'mean': mean, 'stdev': stdev,
+            'min': ordered[0], 'max': ordered[-1]}
+
+
+def run_benchmark(node, args, env_dir, opt):
+    """
+    Runs node once and returns the time in milliseconds: the one printed
+    by the script for built-in benchmarks, the wall time otherwise
+    """
+    env = os.environ.copy()
+    env.update(get_env_vars(env_dir, opt))
+    start = time.time()
+    proc = subprocess.Popen([node] + args, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, env=env)
+    output = proc.communicate()[0]
+    elapsed = (time.time() - start) * 1000.0
+    if proc.returncode:
+        raise NodeenvError('Benchmark %s failed with error code %s:\n%s'
+                           % (' '.join(args), proc.returncode,
+                              output.decode('utf-8', 'replace')))
+    m = re.search(r'^elapsed_ms=([\d.]+)$', output.decode('utf-8', 'replace'), re.M)
+    if m:
+        return float(m.group(1))
+    return elapsed
+
+
+def bench_environments(env_dirs, opt):
+    """
+    Runs the built-in benchmarks and ``opt.bench_scripts`` ``opt.bench_runs``
+    times with the node.js of each environment, prints the results side
+    by side and returns them, one entry per environment in ``env_dirs``
+    order; scripts are named by their absolute path
+    """
+    runs = int(opt.bench_runs)
+    if runs < 1:
+        raise NodeenvError('The benchmarks must run at least once')
+    fd, script_path = tempfile.mkstemp(suffix='.js')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(BENCH_JS.encode('utf-8'))
+
+    benchmarks = [(name, ['-e', '0'] if name == 'startup' else [script_path, name])
+                  for name in BENCHMARKS]
+    for path in opt.bench_scripts:
+        if abspath(path) not in [name for name, args in benchmarks]:
+            benchmarks.append((abspath(path), [abspath(path)]))
+
+    results = []
+    try:
+        for env_dir in env_dirs:
+            node = get_node_executable(env_dir, opt)
+            if not os.path.exists(node):
+                raise NodeenvError('No node.js in environment %s' % env_dir)
+            logger.info(' * Benchmarking %s ', env_dir, extra=dict(continued=True))
+            env_results = {}
+            for name, args in benchmarks:
+                samples = []
+                for i in range(runs):
+                    samples.append(run_benchmark(node, args, env_dir, opt))
+                env_results[name] = summarize(samples)
+                logger.info('.', extra=dict(continued=True))
+            logger.info(' done.')
+            results.append({
+                'env_dir': abspath(env_dir),
+                'build': load_env_options(env_dir),
+                'results': env_results,
+            })
+    finally:
+        os.remove(script_path)
+
+    # median +- stdev in ms, one column per environment
+    names = [name for name, args in benchmarks]
+    headers = ['benchmark (ms)'] + env_dirs
+    rows = [headers]
+    for name in names:
+        row = [name]
+        for env_results in results:
+            stats = env_results['results'][name]
+            row.append('%.1f +- %.1f' % (stats['median'], stats['stdev']))
+        rows.append(row)
+    widths = [max(len(row[i]) for row in rows) for i in range(len(headers))]
+    for row in rows:
+        logger.info('  '.join(cell.ljust(width)
+                              for cell, width in zip(row, widths)).rstrip())
+
+    if opt.bench_json:
+        with open(opt.bench_json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return results
+
+
+# ---------------------------------------------------------
+# Environment service
+
+# Options which change the result of a node.js build; environments built
+# with the same values can be cloned from each other.
+TEMPLATE_OPTIONS = ['node', 'without_ssl', 'debug', 'profile',
+                    'features', 'build_profile', 'slim', 'keep_headers',
+                    'side_by_side', 'with_npm', 'npm', 'no_npm_clean']
+
+
+class NodeenvServer(object):
+    """
+    Creates, clones and updates environments for clients connected to a
+    Unix socket. The service keeps between requests:
+
+    * the last stable node.js version, refreshed every ``version_ttl``
+      seconds;
+    * built template environments in ``cache_dir``, one per distinct set
+      of ``TEMPLATE_OPTIONS``, which new environments are cloned from.
+
+    At most ``max_builds`` node.js builds run at once.
+    """
+    version_ttl = 600
+
+    def __init__(self, socket_path, cache_dir, max_builds=2):
+        self.socket_path = socket_path
+        self.cache_dir = abspath(cache_dir)
+        self.builds = threading.BoundedSemaphore(max_builds)
+        self.lock = threading.Lock()
+        self.template_locks = {}
+        self.last_version = None
+        self.last_version_time = 0
+
+    def get_last_stable_node_version(self):
+        with self.lock:
+            if (self.last_version is not None and
+                    time.time() - self.last_version_time <= self.version_ttl):
+                return self.last_version
+        # fetched without the lock, which the other requests need too
+        version = get_last_stable_node_version()
+        with self.lock:
+            self.last_version = version
+            self.last_version_time = time.time()
+        return version
+
+    def get_template(self, opt):
+        """
+        Returns the template environment for ``opt``, building it first
+        if needed
+        """
+        values = repr([(name, getattr(opt, name)) for name in TEMPLATE_OPTIONS])
+        key = 'node-%s-%s' % (opt.node,
+                              hashlib.sha1(values.encode('utf-8')).hexdigest()[:10])
+        template_dir = join(self.cache_dir, key)
+
+        with self.lock:
+            template_lock = self.template_locks.setdefault(key, threading.Lock())
+        with template_lock:
+            if not os.path.exists(template_dir):
+                mkdir(self.cache_dir)
+                template_opt = copy.copy(opt)
+                template_opt.requirements = ''
+                template_opt.prompt = None
+                template_opt.clean_src = True
+                template_opt.force = False
+                template_opt.python_virtualenv = False
+                with self.builds:
+                    create_environment(template_dir, template_opt)
+        return template_dir
+
+    def create(self, env_dir, opt):
+        if opt.node is None:
+            opt.node = self.get_last_stable_node_version()
+        if opt.node == 'system' or opt.python_virtualenv:
+            return create_environment(env_dir, opt)
+        return clone_environment(self.get_template(opt), env_dir, opt)
+
+    def handle_request(self, request):
+        """
+        Runs the ``request`` sent by ``send_request()``
+        """
+        command = request.get('command')
+        env_dir = request['env_dir']
+        opt = make_options(**request.get('options', {}))
+        logger.info(' * Request: %s %s', command, env_dir)
+        if command == 'create':
+            info = self.create(env_dir, opt)
+        elif command == 'clone':
+            info = clone_environment(request['source'], env_dir, opt)
+        elif command == 'update':
+            info = update_environment(env_dir, opt)
+        else:
+            raise NodeenvError('Unknown request: %s' % command)
+        return {'env_dir': info.env_dir, 'node': info.node,
+                'bin_dir': info.bin_dir, 'mod_dir': info.mod_dir}
+
+    def serve_forever(self):
+        if is_windows_nt:
+            raise NotImplementedError('The nodeenv service uses Unix sockets '
+                                      'and is not supported on Windows.')
+        if os.path.exists(self.socket_path):
+            # a socket left behind by a service which was killed
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except socket.error:
+                os.remove(self.socket_path)
+            else:
+                raise NodeenvError('A nodeenv service is already listening '
+                                   'on %s' % self.socket_path)
+            finally:
+                probe.close()
+
+        server = socketserver.ThreadingUnixStreamServer(
+            self.socket_path, NodeenvRequestHandler)
+        server.daemon_threads = True
+        server.nodeenv = self
+        logger.info(' * Serving on %s', self.socket_path)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(self.socket_path)
+
+
+class NodeenvRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Reads one JSON request line and answers with one JSON response line
+    """
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            response = {'status': 'ok',
+                        'result': self.server.nodeenv.handle_request(request)}
+        except Exception:
+            e = sys.exc_info()[1]
+            logger.error(' * Request failed: %s', e)
+            response = {'status': 'error', 'error': str(e)}
+        self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+def send_request(socket_path, command, env_dir, opt, source=None):
+    """
+    Sends the request to the nodeenv service listening on ``socket_path``
+    and returns its result
+    """
+    options = dict(opt.__dict__)
+    for name in ('serve', 'server', 'clone', 'update'):
+        options.pop(name, None)
+    # the service does not run in the working directory of the client
+    for name in ('requirements', 'package_mirror', 'cache_dir'):
+        if options.get(name):
+            options[name] = abspath(options[name])
+    request = {'command': command, 'env_dir': abspath(env_dir),
+               'options': options}
+    if source:
+        request['source'] = abspath(source)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+
+    response = json.loads(data.decode('utf-8'))
+    if response['status'] != 'ok':
+        raise NodeenvError(response['error'])
+    return response['result']
+
+
 def main():
     """
     Entry point
     """
+    create_logger()
     opt, args = parse_args()
 
     if opt.list:
         print_node_versions()
         return
 
-    if is_windows_nt:
-        if opt.without_ssl:
-            raise NotImplementedError('Installing node from source is not '
-                                      'supported for Windows, therefore the '
-                                      '--without-ssl argument is invalid.')
-        if opt.debug:
-            raise NotImplementedError('Installing node from source is not '
-                                      'supported for Windows, therefore the '
-                                      '--debug argument is invalid.')
-        if opt.load_average:
-            raise NotImplementedError('Installing node from source is not '
-                                      'supported for Windows, therefore the '
-                                      '--load-average argument is invalid.')
-        if opt.clean_src:
-            raise NotImplementedError('Installing node from source is not '
-                                      'supported for Windows, therefore the '
-                                      '--clean-src argument is invalid.')
-        if not opt.python_virtualenv:
-            raise NotImplementedError('Using nodeenv on Windows is not '
-                                      'supported without an existing Python '
-                                      'virtualenv.')
+    if opt.serve:
+        server = NodeenvServer(opt.serve, opt.cache_dir, int(opt.max_builds))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if opt.quiet:
+        logger.setLevel(logging.CRITICAL)
 
-    if opt.node != 'system' and sys.version_info.major > 2 and not is_windows_nt:
-        logger.error('Python 3.x detected. The node.js build system requires '
-                     'Python 2.6-2.7 to build. Python 3 can only be used with '
-                     'the system version of node.js; specify the -n \'system\' '
-                     'option to use this.')
+    if opt.prefetch or opt.bench or opt.exec_cmd or opt.use or opt.pack \
+            or opt.unpack:
+        try:
+            if opt.prefetch:
+                prefetch_packages(opt.requirements, opt.prefetch_dir, opt)
+            elif opt.bench:
+                bench_environments(args, opt)
+            elif opt.exec_cmd:
+                exec_in_environment(args[0], args[1:], opt)
+            elif opt.use:
+                use_node_version(args[0], opt.use, opt)
+            elif opt.pack:
+                pack_environment(args[0], args[1])
+            else:
+                unpack_environment(args[0], args[1], opt)
+        except NodeenvError:
+            logger.error(str(sys.exc_info()[1]))
+            sys.exit(2)
+        return
+
+    if opt.python_virtualenv:
+        try:
+            env_dir = os.environ['VIRTUAL_ENV']
+        except KeyError:
+            logger.error('No python virtualenv is available')
+            sys.exit(2)
     else:
-        if opt.quiet:
-            logger.setLevel(logging.CRITICAL)
-        if opt.python_virtualenv:
-            try:
-                env_dir = os.environ['VIRTUAL_ENV']
-            except KeyError:
-                logger.error('No python virtualenv is available')
-                sys.exit(2)
+        env_dir = args[0]
+
+    if opt.clone:
+        command = 'clone'
+    elif opt.update:
+        command = 'update'
+    else:
+        command = 'create'
+
+    try:
+        if opt.server:
+            result = send_request(opt.server, command, env_dir, opt,
+                                  source=opt.clone)
+            logger.info(' * Environment ready: %s', result['env_dir'])
+        elif command == 'clone':
+            clone_environment(opt.clone, env_dir, opt)
+        elif command == 'update':
+            update_environment(env_dir, opt)
         else:
-            env_dir = args[0]
-        create_environment(env_dir, opt)
+            create_environment(env_dir, opt)
+    except NodeenvError:
+        logger.error(str(sys.exc_info()[1]))
+        sys.exit(2)
 
 
 # ---------------------------------------------------------
@@ -913,6 +3041,100 @@ if [ -n "$BASH" -o -n "$ZSH_VERSION" ] ; then
 fi
 """
 
+PGO_TRAINING_JS = """\
+// Training workload for the profile guided optimization build.
+var crypto = require('crypto');
+var http = require('http');
+
+var data = [];
+for (var i = 0; i < 2000; i++) {
+    data.push({id: i, name: 'item-' + i, tags: ['a', 'b', 'c'], value: i / 3});
+}
+for (var j = 0; j < 200; j++) {
+    JSON.parse(JSON.stringify(data));
+    crypto.createHash('sha256').update(JSON.stringify(data[j])).digest('hex');
+    'nodeenv-' + j + '-training'.replace(/[aeiou]/g, '_').split('-').join('.');
+}
+
+var server = http.createServer(function (req, res) {
+    res.end(JSON.stringify({url: req.url}));
+});
+server.listen(0, '127.0.0.1', function () {
+    var port = server.address().port;
+    var left = 500;
+    (function next() {
+        if (left-- === 0) {
+            return server.close();
+        }
+        http.get({host: '127.0.0.1', port: port, path: '/' + left}, function (res) {
+            res.resume();
+            res.on('end', next);
+        });
+    })();
+});
+"""
+
+BENCH_JS = """\
+// Built-in benchmarks of nodeenv --bench; prints the time of the run.
+var crypto = require('crypto');
+var http = require('http');
+
+function now() {
+    var t = process.hrtime();
+    return t[0] * 1e3 + t[1] / 1e6;
+}
+
+function done(start) {
+    console.log('elapsed_ms=' + (now() - start).toFixed(3));
+}
+
+var benchmarks = {
+    json: function () {
+        var start = now();
+        var data = [];
+        for (var i = 0; i < 5000; i++) {
+            data.push({id: i, name: 'item-' + i, tags: ['a', 'b'], value: i / 7});
+        }
+        for (var j = 0; j < 50; j++) {
+            JSON.parse(JSON.stringify(data));
+        }
+        done(start);
+    },
+    crypto: function () {
+        var start = now();
+        var size = 1024 * 1024;
+        var buf = Buffer.alloc ? Buffer.alloc(size) : new Buffer(size);
+        buf.fill(7);
+        for (var i = 0; i < 50; i++) {
+            crypto.createHash('sha256').update(buf).digest('hex');
+        }
+        done(start);
+    },
+    http: function () {
+        var server = http.createServer(function (req, res) {
+            res.end('ok');
+        });
+        server.listen(0, '127.0.0.1', function () {
+            var port = server.address().port;
+            var left = 1000;
+            var start = now();
+            (function next() {
+                if (left-- === 0) {
+                    done(start);
+                    return server.close();
+                }
+                http.get({host: '127.0.0.1', port: port, path: '/'}, function (res) {
+                    res.resume();
+                    res.on('end', next);
+                });
+            })();
+        });
+    }
+};
+
+benchmarks[process.argv[2]]();
+"""
+
 NODE_BAT = """\
 @ECHO OFF
 